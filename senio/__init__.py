@@ -1,9 +1,16 @@
 from senio.processors import processor_all, processor_rgbn
 from senio.utils import (
     __version__,
+    calculate_band_statistics,
     calculate_statistics,
     check_path_validity,
     create_pam_xml,
+    gdal_version,
+    read_band,
+    read_bands,
+    resample_stack,
     setup_logger,
     stack_sort,
+    upsample_nearest,
+    write_cog,
 )
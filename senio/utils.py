@@ -1,11 +1,14 @@
 import logging
 import os
 import pathlib
-import sys
-import xml.etree.ElementTree as et
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
 import numpy as np
+import rasterio
+import rasterio.enums
+import rasterio.shutil
 
 
 def __version__() -> str:
@@ -13,8 +16,13 @@ def __version__() -> str:
     return "1.0"
 
 
+def gdal_version() -> tuple:
+    """Returns the (major, minor) version of the GDAL library that rasterio is built against."""
+    return tuple(int(part) for part in rasterio.__gdal_version__.split(".")[:2])
+
+
 def setup_logger(log_file: str, log_to_file=False) -> logging.RootLogger:
-    """Creates the logger and saves it in the Logs folder (optional)."""
+    """Creates the logger and saves it in the Logs folder (optional). Calling it again does not duplicate handlers."""
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
@@ -27,21 +35,26 @@ def setup_logger(log_file: str, log_to_file=False) -> logging.RootLogger:
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
 
-        log_file_path = os.path.join(log_dir, log_file)
+        log_file_path = os.path.abspath(os.path.join(log_dir, log_file))
 
-        file_handler = logging.FileHandler(log_file_path)
-        file_handler.setFormatter(formatter)
+        if not any(
+            isinstance(handler, logging.FileHandler) and handler.baseFilename == log_file_path
+            for handler in logger.handlers
+        ):
+            file_handler = logging.FileHandler(log_file_path)
+            file_handler.setFormatter(formatter)
 
-        logger.addHandler(file_handler)
+            logger.addHandler(file_handler)
     else:
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
+        if not any(type(handler) is logging.StreamHandler for handler in logger.handlers):
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(formatter)
+
+            logger.addHandler(console_handler)
 
-        logger.addHandler(console_handler)
-    
     return logger
 
-logger = setup_logger(log_file="logs.log", log_to_file=True)
+logger = logging.getLogger(__name__)
 
 def check_path_validity(product_path: pathlib.Path) -> pathlib.Path:
     """Checks if the product path is valid. If compressed, it unzip's it in the parent folder."""
@@ -52,77 +65,208 @@ def check_path_validity(product_path: pathlib.Path) -> pathlib.Path:
         raise SystemExit(f"File does not have the correct suffix")
 
     if product_path.suffix == ".zip":
-        logger.info(f"Zip-file detected: {product_path}")
+        logger.info("Zip-file detected: %s", product_path)
         with zipfile.ZipFile(product_path, "r") as zfile:
             zfile.extractall(path=product_path.parent)
-            logger.info(f"Extracted in {product_path.parent}")
+            logger.info("Extracted in %s", product_path.parent)
             product_path = product_path.with_suffix("")
             product_path = product_path.with_suffix(".SAFE")
     else:
-        logger.info(f"SAFE-file detected: {product_path}")
+        logger.info("SAFE-file detected: %s", product_path)
 
     return product_path
 
 
+def read_band(band_path: pathlib.Path, out: np.ndarray) -> np.ndarray:
+    """Reads the first band of a raster directly into the given 2D array."""
+    with rasterio.open(band_path) as src:
+        return src.read(1, out=out)
+
+
+def read_bands(band_paths: list, out_arrays: list) -> list:
+    """Decodes the bands concurrently (GDAL releases the GIL), one band per thread, into the given 2D arrays, paired in input order."""
+    with rasterio.Env(GDAL_CACHEMAX=512):
+        with ThreadPoolExecutor(max_workers=min(len(band_paths), os.cpu_count())) as executor:
+            arrays = list(executor.map(read_band, band_paths, out_arrays))
+
+    return arrays
+
+
+def calculate_band_statistics(band: np.ndarray) -> dict:
+    """Calculates the (min, max, mean, std) of a uint16 band, from its 65536-bin histogram."""
+    histogram = np.zeros(65536, dtype=np.int64)
+    for row in range(0, band.shape[0], 1024):
+        histogram += np.bincount(band[row : row + 1024].ravel(), minlength=65536)
+
+    bins = np.arange(65536, dtype=np.float64)
+    values = np.flatnonzero(histogram)
+    count = histogram.sum()
+    mean = np.dot(histogram, bins) / count
+    variance = np.dot(histogram, (bins - mean) ** 2) / count
+
+    return {
+        "min": values[0],
+        "max": values[-1],
+        "mean": mean,
+        "std": np.sqrt(variance),
+    }
+
+
 def calculate_statistics(stack_array: np.ndarray) -> list:
-    """Calculates the (min, max, mean, std) for each band in the array."""
-    statistics = [
-        {
-            "min": np.nanmin(band.flatten()),
-            "max": np.nanmax(band.flatten()),
-            "mean": np.nanmean(band.flatten()),
-            "std": np.nanstd(band.flatten()),
-        }
-        for band in stack_array
-    ]
+    """Calculates the (min, max, mean, std) for each band in the array, one band per thread."""
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        statistics = list(executor.map(calculate_band_statistics, stack_array))
 
     return statistics
 
 
-def stack_sort(stack_array: np.ndarray, code_list: list, sorted_list: list) -> list:
+def stack_sort(stack_array: np.ndarray, code_list: list, sorted_list: list) -> np.ndarray:
     """Sorts the array given a prior, and a reference list."""
+    position = {code: index for index, code in enumerate(code_list)}
+    sorted_index = np.array([position[code] for code in sorted_list], dtype=np.intp)
+
+    logger.info("Sorted input list: %s", sorted_list)
+
+    return stack_array[sorted_index]
+
+
+def upsample_nearest(stack_array: np.ndarray, scale_factor: int) -> np.ndarray:
+    """Upsamples each band by an integer factor with nearest neighbour replication, in a single copy."""
     band, row, column = stack_array.shape
-    stack_sorted = np.zeros((band, row, column), dtype=np.uint16)
+    upsampled = np.empty((band, row * scale_factor, column * scale_factor), dtype=stack_array.dtype)
+    upsampled.reshape(band, row, scale_factor, column, scale_factor)[...] = stack_array[:, :, np.newaxis, :, np.newaxis]
 
-    len_list_bands = len(code_list)
-    c_arr = np.zeros((len_list_bands), dtype=np.uint8)
+    return upsampled
 
-    count = 0
-    count_sort = 0
 
-    while count_sort != len_list_bands:
-        if code_list[count] == sorted_list[count_sort]:
-            c_arr[count_sort] = count
-            count_sort = count_sort + 1
-            count = 0
-        else:
-            count = count + 1
+def resample_stack(
+    stack_array: np.ndarray, profile: dict, scale_factor: int, resampling: rasterio.enums.Resampling
+) -> tuple:
+    """
+    Upsamples the stack by an integer factor, and returns it alongside its new transform. Non-nearest methods go through a
+    resampled read of an in-memory GTiff, which keeps GDAL's RasterIO edge handling (rasterio.warp.reproject treats the
+    first and last rows and columns differently).
+    """
+    transform = profile["transform"] * profile["transform"].scale(1 / scale_factor)
 
-    logger.info(f"Sorted input list: {sorted_list}")
+    if resampling == rasterio.enums.Resampling.nearest:
+        return upsample_nearest(stack_array, scale_factor), transform
 
-    for sorted_band in range(0, len_list_bands):
-        stack_sorted[sorted_band, :, :] = stack_array[c_arr[sorted_band], :, :]
+    band, row, column = stack_array.shape
+    mem_kwargs = profile.copy()
+    mem_kwargs.update(
+        {
+            "driver": "GTiff",
+            "interleave": "band",
+            "count": band,
+            "dtype": stack_array.dtype,
+        }
+    )
+
+    with rasterio.MemoryFile() as memfile:
+        with memfile.open(**mem_kwargs) as mem:
+            mem.write(stack_array)
+            resampled = mem.read(out_shape=(band, row * scale_factor, column * scale_factor), resampling=resampling)
+
+    return resampled, transform
+
+
+def write_cog(
+    bands: Iterator[np.ndarray], count: int, profile: dict, out_name: pathlib.Path, pyramids: bool, interleave: str
+) -> None:
+    """
+    Writes the uint16 bands one at a time into a temporary band-interleaved tiled GTiff next to the output, and copies it
+    into a Cloud Optimized GeoTIFF with internal pyramids. With GDAL 3.11+ the COG driver is used (it only supports
+    CreateCopy). Older COG drivers have no INTERLEAVE option, so there the pyramids are built on the staging file, and a
+    tiled GTiff is created with COPY_SRC_OVERVIEWS=YES, which gives the same cloud optimized layout in the requested
+    interleave. The staging file is always band-interleaved, so each of its tiles is written once, and deliberately left
+    uncompressed: it is written and read back once, so a codec would only add CPU time (do not add ZSTD to it). The bands iterator is
+    consumed, and drops its arrays once exhausted, so when the caller holds no other references the source arrays are
+    released before the copy.
+    """
+    temp_name = out_name.with_name(out_name.stem + "_TEMP.tif")
+    use_cog_driver = gdal_version() >= (3, 11)
+
+    temp_kwargs = {
+        "driver": "GTiff",
+        "width": profile["width"],
+        "height": profile["height"],
+        "count": count,
+        "dtype": rasterio.uint16,
+        "crs": profile["crs"],
+        "transform": profile["transform"],
+        "nodata": profile.get("nodata"),
+        "tiled": True,
+        "blockxsize": 1024,
+        "blockysize": 1024,
+        "interleave": "band",
+        "bigtiff": "IF_SAFER",
+    }
+
+    if use_cog_driver:
+        copy_kwargs = {
+            "driver": "COG",
+            "blocksize": 1024,
+            "compress": "zstd",
+            "level": 1,
+            "predictor": "YES",
+            "interleave": interleave,
+            "overviews": "AUTO" if pyramids else "NONE",
+            "overview_resampling": "average",
+            "overview_compress": "zstd",
+            "num_threads": "ALL_CPUS",
+        }
+    else:
+        copy_kwargs = {
+            "driver": "GTiff",
+            "tiled": True,
+            "blockxsize": 1024,
+            "blockysize": 1024,
+            "compress": "zstd",
+            "zstd_level": 1,
+            "predictor": 2,
+            "interleave": interleave,
+            "copy_src_overviews": "YES",
+            "bigtiff": "IF_SAFER",
+            "num_threads": "ALL_CPUS",
+        }
 
-    return stack_sorted
+    try:
+        with rasterio.Env(NUM_THREADS="ALL_CPUS", GDAL_NUM_THREADS="ALL_CPUS", GDAL_TIFF_OVR_BLOCKSIZE=1024):
+            with rasterio.open(temp_name, "w", **temp_kwargs) as dst:
+                for index, band in enumerate(bands, start=1):
+                    dst.write(band, index)
+                band = None
 
+                if pyramids and not use_cog_driver:
+                    dst.build_overviews([2, 4, 8, 16], rasterio.enums.Resampling.average)
+
+            rasterio.shutil.copy(temp_name, out_name, **copy_kwargs)
+    finally:
+        temp_name.unlink(missing_ok=True)
 
-def create_pam_xml(stack_array: np.ndarray, out_name: pathlib.Path) -> None:
-    """Computes the image statistics, and saves them in an XML file (GDAL PAMDataset)."""
-    bands = [f"{band}" for band in range(1, stack_array.shape[0] + 1)]
-    stats = calculate_statistics(stack_array)
 
-    pam_dataset = et.Element("PAMDataset")
-    for band in bands:
-        pam_array_band = et.SubElement(pam_dataset, "PAMRasterBand", band=band)
-        metadata = et.SubElement(pam_array_band, "Metadata")
-        et.SubElement(metadata, "MDI", key="STATISTICS_MINIMUM").text = str(stats[int(band) - 1]["min"])
-        et.SubElement(metadata, "MDI", key="STATISTICS_MAXIMUM").text = str(stats[int(band) - 1]["max"])
-        et.SubElement(metadata, "MDI", key="STATISTICS_MEAN").text = str(stats[int(band) - 1]["mean"])
-        et.SubElement(metadata, "MDI", key="STATISTICS_STDDEV").text = str(stats[int(band) - 1]["std"])
-
-    tree = et.ElementTree(pam_dataset)
-
-    if sys.version_info[1] >= 9:
-        et.indent(tree, space="\t", level=0)
-        
-    tree.write(out_name.with_suffix(".tif.aux.xml").as_posix())
+def create_pam_xml(stack_array: np.ndarray, out_name: pathlib.Path, approximate: bool = False) -> None:
+    """
+    Computes the image statistics of a band array (or a list of bands), and saves them in an XML file (GDAL PAMDataset). Set
+    approximate for sampled bands, so GDAL and QGIS do not reuse the statistics as exact ones.
+    """
+    stats = calculate_statistics(stack_array)
+    approximate_mdi = '\t\t\t<MDI key="STATISTICS_APPROXIMATE">YES</MDI>\n' if approximate else ""
+
+    parts = ["<PAMDataset>"]
+    for band, band_stats in enumerate(stats, start=1):
+        parts.append(
+            f'\t<PAMRasterBand band="{band}">\n'
+            f"\t\t<Metadata>\n"
+            f"{approximate_mdi}"
+            f'\t\t\t<MDI key="STATISTICS_MINIMUM">{band_stats["min"]}</MDI>\n'
+            f'\t\t\t<MDI key="STATISTICS_MAXIMUM">{band_stats["max"]}</MDI>\n'
+            f'\t\t\t<MDI key="STATISTICS_MEAN">{band_stats["mean"]}</MDI>\n'
+            f'\t\t\t<MDI key="STATISTICS_STDDEV">{band_stats["std"]}</MDI>\n'
+            f"\t\t</Metadata>\n"
+            f"\t</PAMRasterBand>"
+        )
+    parts.append("</PAMDataset>")
+
+    out_name.with_suffix(".tif.aux.xml").write_text("\n".join(parts))